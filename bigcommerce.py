@@ -8,10 +8,480 @@ from __future__ import division
 import requests
 import csv
 import base64
+import argparse
+from email.utils import formatdate, mktime_tz, parsedate_tz
+import io
 import json
+import os
 import pprint
+import itertools
+import numbers
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
 from multiprocessing.dummy import Pool as ThreadPool
 
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+def _field(type_name, choices=None, name=None):
+    """
+    Describes one request field for BigCommerce._buildPayload.
+    type_name -> one of the keys of _field_checks
+    choices   -> optional tuple of allowed values
+    name      -> api name, if it differs from the argument name
+    """
+    return (type_name, choices, name)
+
+
+def _checkInt(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Integral):
+        return True
+    return isinstance(value, string_types) and re.match(r"^[+-]?\d+$", value.strip()) is not None
+
+
+def _checkNumber(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Real):
+        return True
+    if isinstance(value, string_types):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+def _checkStr(value):
+    # numbers are accepted for ids such as sku and sent as strings
+    return isinstance(value, string_types) or _checkNumber(value)
+
+
+def _checkBool(value):
+    if isinstance(value, bool):
+        return True
+    return isinstance(value, string_types) and value.lower() in ("true", "false")
+
+
+_field_checks = {
+                 "int": _checkInt,
+                 "number": _checkNumber,
+                 "bool": _checkBool,
+                 "str": _checkStr,
+                 "date": lambda value: isinstance(value, string_types),
+                 "list": lambda value: isinstance(value, (list, tuple)),
+                 "any": lambda value: True
+                 }
+
+
+def _iterJSONArray(r, chunk_size=16384):
+    """
+    Parses the json array body of a streamed response (stream=True)
+    incrementally, yielding each element as soon as it has fully arrived.
+    gzip/deflate bodies are decompressed by requests chunk by chunk.
+    """
+    if r.encoding is None:
+        r.encoding = "utf-8"
+    chunks = r.iter_content(chunk_size=chunk_size, decode_unicode=True)
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    in_array = False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf):
+            if not in_array:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a json array.")
+                in_array = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # a number may be cut off by the end of the buffer, even
+                # right after its "." or "e" ("1." decodes as 1)
+                if eof or (end < len(buf) and buf[end] not in ".eE+-0123456789"):
+                    pos = end
+                    yield item
+                    continue
+        elif eof:
+            raise ValueError("Unexpected end of json array.")
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            chunk = ""
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def _retryAfter(value, default=1):
+    """
+    RETURNS the seconds to wait for a Retry-After header, which is either a
+    number of seconds or an http date.  Missing or unreadable values give
+    {default}.
+    """
+    if value is None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return default
+    return max(0, mktime_tz(date) - time.time())
+
+
+class _FileBody(object):
+    """
+    Hands out a text file the way _iterJSONArray reads a streamed response.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.encoding = "utf-8"
+
+    def iter_content(self, chunk_size, decode_unicode):
+        return iter(lambda: self.f.read(chunk_size), "")
+
+
+def _iterFeed(path):
+    """
+    Yields the rows of a feed file one at a time as dictionaries.  Files
+    ending in .jsonl hold one json object per line, files ending in .json a
+    json array of objects, which is parsed as it is read.  Anything else is
+    read as csv with a header row.
+    """
+    if path.endswith(".jsonl"):
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode("utf-8"))
+    elif path.endswith(".json"):
+        with io.open(path, "r", encoding="utf-8") as f:
+            for row in _iterJSONArray(_FileBody(f)):
+                yield row
+    else:
+        # csv wants bytes on python 2 and text on python 3
+        if sys.version_info[0] < 3:
+            f = open(path, "rb")
+        else:
+            f = open(path, "r", newline="")
+        with f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def _chunks(iterable, size):
+    """
+    Yields lists of up to {size} items from iterable.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _sameValue(old, new):
+    # "12.9900" from the api and 12.99 from a feed are the same price
+    try:
+        return Decimal(str(old)) == Decimal(str(new))
+    except (InvalidOperation, ValueError):
+        return str(old) == str(new)
+
+
+def _feedValue(type_name, value):
+    """
+    RETURNS a validated feed value the way the api expects it, instead of
+        the text read from the feed: ints for int fields, plain decimal
+        strings for numbers and booleans for bool fields.
+    """
+    if type_name == "int":
+        return int(str(value).strip())
+    if type_name == "number":
+        return "{:f}".format(Decimal(str(value).strip()))
+    if type_name == "bool" and not isinstance(value, bool):
+        return value.lower() == "true"
+    return value
+
+
+def _writeJSON(path, data):
+    """
+    Writes data to path as json, replacing the old file atomically so a crash
+    never leaves a half written file behind.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    if hasattr(os, "replace"):
+        os.replace(temp_path, path)
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+
+def _makeSession(pool_size=32):
+    """
+    RETURNS a requests session whose connection pool is large enough for
+    every thread of the ThreadPools in this module.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class _InflightCall(object):
+    """
+    A GET request that is currently on the wire.  Threads asking for the
+    same request wait on done and then share result (or error).
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+# request priorities, lower goes first, see BigCommerce.priority
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+# the priority of requests sent from the current thread
+_local = threading.local()
+
+
+class _NotFound(object):
+    """
+    Marks identifiers that matched no product in getProducts and
+    getProductsById.  It is falsy, so "if products[sku]:" checks for a hit.
+    """
+
+    def __repr__(self):
+        return "NOT_FOUND"
+
+    def __bool__(self):
+        return False
+    __nonzero__ = __bool__
+
+
+NOT_FOUND = _NotFound()
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to an endpoint whose circuit breaker
+    is open.
+    """
+    pass
+
+
+class _CircuitBreaker(object):
+    """
+    Stops requests to one endpoint after {failures} failures in a row.  Once
+    {reset} seconds have passed a single trial request is let through;
+    success closes the circuit again and failure keeps it open.
+    """
+
+    def __init__(self, failures, reset):
+        self.failures = failures
+        self.reset = reset
+        self.count = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() - self.opened_at < self.reset:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, ok):
+        with self.lock:
+            self.trial = False
+            if ok:
+                self.count = 0
+                self.opened_at = None
+            else:
+                self.count += 1
+                if self.count >= self.failures:
+                    self.opened_at = time.time()
+
+
+class _RateLimiter(object):
+    """
+    Token bucket holding the request budget shared by every request.
+    While requests are waiting, each new token goes to the waiter with the
+    best (lowest) priority, in arrival order.  A waiter moves up one priority
+    level every {aging} seconds, so bulk requests use whatever the more
+    urgent ones leave over but are never starved.
+    """
+
+    def __init__(self, rate, burst, aging=5):
+        self.rate = rate
+        self.burst = burst
+        self.aging = aging
+        self.tokens = burst
+        self.updated = time.time()
+        self.resume_at = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def _rank(self, waiter, now):
+        priority, number, since = waiter
+        return (priority - (now - since) // self.aging, number)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority):
+        """
+        Blocks until this request may be sent.
+        """
+        with self.cond:
+            waiter = (priority, next(self.counter), time.time())
+            self.waiters.append(waiter)
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    first = min(self.waiters, key=lambda w: self._rank(w, now))
+                    if now < self.resume_at:
+                        wait = self.resume_at - now
+                    elif self.tokens < 1:
+                        wait = (1 - self.tokens) / self.rate
+                    elif first is waiter:
+                        self.tokens -= 1
+                        return
+                    else:
+                        # a token is free but a more urgent waiter gets it
+                        wait = self.aging
+                    self.cond.wait(wait)
+            finally:
+                self.waiters.remove(waiter)
+                self.cond.notify_all()
+
+    def tryAcquire(self):
+        """
+        Takes a token only if it is spare: the budget isn't paused and no
+        request is waiting for it.
+        RETURNS   -> True if a token was taken
+        """
+        with self.cond:
+            now = time.time()
+            self._refill(now)
+            if self.waiters or now < self.resume_at or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for {seconds}, used when the api answers 429.
+        """
+        with self.cond:
+            self.resume_at = max(self.resume_at, time.time() + seconds)
+            self.tokens = 0
+            self.cond.notify_all()
+
+
+class _Checkpoint(object):
+    """
+    Progress of a long crawl, saved to disk so it can resume after a crash.
+    <path>       -> json file with the crawl state (page, phase, ...)
+    <path>.items -> records fetched so far, one [kind, record] per line
+    The state also holds the byte offset up to which the items file is
+    valid, so records appended after the last save are dropped on resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.items_path = path + ".items"
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.state = json.load(f)
+        self._items = open(self.items_path, "ab")
+        self._items.truncate(self.state.get("offset", 0))
+        self._items.seek(0, os.SEEK_END)
+
+    def records(self):
+        """
+        Yields (kind, record) for everything saved by a previous run.
+        """
+        with open(self.items_path, "rb") as f:
+            for line in f:
+                kind, record = json.loads(line.decode("utf-8"))
+                yield kind, record
+
+    def append(self, kind, records):
+        for record in records:
+            self._items.write((json.dumps([kind, record]) + "\n").encode("utf-8"))
+
+    def save(self, **state):
+        """
+        Flushes appended records and atomically replaces the state file.
+        """
+        self._items.flush()
+        os.fsync(self._items.fileno())
+        state["offset"] = self._items.tell()
+        self.state = state
+        _writeJSON(self.path, state)
+
+    def clear(self):
+        """
+        Removes the checkpoint once the crawl has finished.
+        """
+        self._items.close()
+        for path in (self.path, self.items_path):
+            if os.path.exists(path):
+                os.remove(path)
+
 
 class BigCommerce(object):
     error_codes = {
@@ -31,8 +501,41 @@ class BigCommerce(object):
                    409: "Conflict",
                    413: "Request Entity Too Large",
                    415: "Unsupported Media Type",
-                   429: "Too Many Requests"
+                   429: "Too Many Requests",
+                   500: "Internal Server Error",
+                   502: "Bad Gateway",
+                   503: "Service Unavailable",
+                   504: "Gateway Timeout"
                    }
+    # (connect, read) timeout in seconds for every request
+    timeout = (10, 60)
+    # a GET slower than this percentile of its endpoint's recent latencies
+    # gets a duplicate (hedged) request, whichever answers first wins
+    hedge_percentile = 95
+    hedge_min_samples = 20
+    # request budget shared by every request of the process, in requests per
+    # second (the legacy api allows 20,000 an hour).  None turns it off.
+    rate_limit = 20000 / 3600
+    rate_burst = 10
+    # times a request answered with 429 Too Many Requests is sent again
+    max_retries = 3
+    # consecutive failures before an endpoint's circuit opens, and the
+    # seconds it stays open before a trial request is let through
+    breaker_failures = 5
+    breaker_reset = 30
+    # GET requests currently in flight, shared by every instance.
+    _inflight = {}
+    _inflight_lock = threading.Lock()
+    # per endpoint latencies and circuit breakers, shared by every instance
+    _latencies = {}
+    _breakers = {}
+    _stats_lock = threading.Lock()
+    _rate_limiter = None
+    # one pooled session for the whole process so connections stay open
+    # between requests (and between runs of SyncDaemon jobs)
+    session = _makeSession()
+    # contents of bc.data, see _readConfig
+    _config = None
 
     def __init__(self):
         # user and key from settings -> legacy api settings
@@ -45,49 +548,396 @@ class BigCommerce(object):
         self.headers = {
                'Content-Type': 'application/json',
                'Accept': 'application/json',
+               'Accept-Encoding': 'gzip, deflate',
                'Authorization': 'Basic ' + self.auth,
                'User-Agent': 'python-bigcommerce v0.1'
                }
 
+    @staticmethod
+    def _readConfig():
+        """
+        Reads bc.data once per process and caches it.
+        RETURNS   -> {setting: value}
+        """
+        if BigCommerce._config is None:
+            config = {}
+            with open("bc.data", "rb") as f:
+                for line in f:
+                    line = line.split()
+                    if len(line) >= 2:
+                        config[line[0]] = line[1]
+            BigCommerce._config = config
+        return BigCommerce._config
+
     @staticmethod
     def _getUser():
-        with open("bc.data", "rb") as f:
-            for line in f:
-                line = line.split()
-                # print(line[0])
-                if line[0] == "user":
-                    user = line[1]
         try:
-            return user
-        except:
+            return BigCommerce._readConfig()["user"]
+        except KeyError:
             raise Exception("No User Found in bc.data.  Add 'user <user>' to bc.data file.")
 
     @staticmethod
     def _getKey():
-        with open("bc.data", "rb") as f:
-            for line in f:
-                line = line.split()
-                if line[0] == "key":
-                    key = line[1]
         try:
-            return key
-        except:
+            return BigCommerce._readConfig()["key"]
+        except KeyError:
             raise Exception("No Key Found in bc.data.  Add 'key <key>' to bc.data file.")
 
     @staticmethod
     def _getPath():
-        with open("bc.data", "rb") as f:
-            for line in f:
-                line = line.split()
-                if line[0] == "path":
-                    path = line[1]
         try:
-            return path
-        except:
+            return BigCommerce._readConfig()["path"]
+        except KeyError:
             raise Exception("No Key Found in bc.data.  Add 'key <key>' to bc.data file.")
 
+    @staticmethod
+    def _buildPayload(fields, values):
+        """
+        Builds a request payload from a field schema, validating it on the
+        client so that bad requests fail before using any of the rate limit.
+        __VARIABLES__
+        fields -> {argument name: _field(...)}
+        values -> {argument name: value}, usually the caller's locals()
+        Arguments that are None are left out.
+        Raises ValueError on a wrong type or a value outside of the choices.
+        """
+        payload = {}
+        for arg, (type_name, choices, name) in fields.items():
+            value = values.get(arg)
+            if value is None:
+                continue
+            if not _field_checks[type_name](value):
+                raise ValueError("Invalid value for {}: {!r} (expected {}).".format(arg, value, type_name))
+            if choices is not None and value not in choices:
+                raise ValueError("Invalid value for {}: {!r} (expected one of {}).".format(arg, value, ", ".join(choices)))
+            if type_name == "str" and not isinstance(value, string_types):
+                value = str(value)
+            elif type_name in ("int", "number") and isinstance(value, string_types):
+                value = value.strip()
+            payload[name or arg] = value
+        return payload
+
+    @staticmethod
+    def _checkStatus(r, allowed=()):
+        """
+        Raises an Exception unless r has a 2xx status or one listed in allowed.
+        """
+        if r.status_code in allowed or str(r.status_code).startswith("2"):
+            return
+        raise Exception("Error {}: {}.".format(r.status_code, BigCommerce.error_codes.get(r.status_code, "Unknown Error")))
+
+    def _get(self, path, params=None):
+        """
+        GET with single-flight coalescing.
+        Concurrent calls for the same path and params (with the same
+        credentials) share one request and get back the same response object.
+        RETURNS   -> the request response
+        """
+        params = params or {}
+        key = (
+               path,
+               self.headers["Authorization"],
+               tuple(sorted((k, str(v)) for k, v in params.items()))
+               )
+        with BigCommerce._inflight_lock:
+            call = BigCommerce._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _InflightCall()
+                BigCommerce._inflight[key] = call
+        if not leader:
+            return call.wait()
+        try:
+            call.result = self._hedgedGet(path, params)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with BigCommerce._inflight_lock:
+                del BigCommerce._inflight[key]
+            call.done.set()
+        return call.result
+
+    @staticmethod
+    def _endpoint(path):
+        # products/123/images and products/456/images share one endpoint
+        return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+    def _request(self, method, path, sent=None, have_token=False, **kwargs):
+        """
+        Sends a request with the default timeout, unless the endpoint's circuit
+        breaker is open.  Timeouts, connection errors and 5xx responses count
+        as failures.  The request waits for its turn in the shared rate budget,
+        and 429 responses pause the budget and are retried.
+        sent       -> optional threading.Event, set once the request has had its
+            turn in the rate budget and goes out
+        have_token -> the caller already took the budget token for the first
+            attempt
+        RETURNS   -> the request response
+        """
+        endpoint = self._endpoint(path)
+        breaker = self._breaker(path)
+        if not breaker.allow():
+            raise CircuitOpenError("Circuit open for {}, not sending request.".format(endpoint))
+        kwargs.setdefault("timeout", self.timeout)
+        limiter = self._rateLimiter()
+        # any exception counts as a failure, otherwise a half open breaker
+        # would wait for the result of its trial request forever
+        try:
+            for attempt in range(self.max_retries + 1):
+                if limiter is not None and not (have_token and attempt == 0):
+                    limiter.acquire(self._priority())
+                if sent is not None:
+                    sent.set()
+                start = time.time()
+                r = BigCommerce.session.request(method, path, headers=self.headers, **kwargs)
+                if r.status_code != 429 or limiter is None:
+                    break
+                # give the connection back before waiting, a streamed body
+                # would hold it for the whole pause
+                r.close()
+                limiter.pause(_retryAfter(r.headers.get("X-Retry-After") or r.headers.get("Retry-After")))
+        except Exception:
+            breaker.record(False)
+            raise
+        # a streamed body can still fail after the headers arrived, so the
+        # caller records how reading it went
+        if not kwargs.get("stream") or r.status_code >= 500:
+            breaker.record(r.status_code < 500)
+        if method == "GET" and r.status_code < 500:
+            with BigCommerce._stats_lock:
+                latencies = BigCommerce._latencies.setdefault(endpoint, deque(maxlen=200))
+                latencies.append(time.time() - start)
+        return r
+
+    def _breaker(self, path):
+        """
+        RETURNS the circuit breaker of the endpoint path belongs to
+        """
+        endpoint = self._endpoint(path)
+        with BigCommerce._stats_lock:
+            breaker = BigCommerce._breakers.get(endpoint)
+            if breaker is None:
+                breaker = _CircuitBreaker(self.breaker_failures, self.breaker_reset)
+                BigCommerce._breakers[endpoint] = breaker
+            return breaker
+
+    @classmethod
+    def _rateLimiter(cls):
+        if cls.rate_limit is None:
+            return None
+        with BigCommerce._stats_lock:
+            if BigCommerce._rate_limiter is None:
+                BigCommerce._rate_limiter = _RateLimiter(cls.rate_limit, cls.rate_burst)
+            return BigCommerce._rate_limiter
+
+    @staticmethod
+    def _priority():
+        priority = getattr(_local, "priority", None)
+        return PRIORITY_NORMAL if priority is None else priority
+
+    @contextmanager
+    def priority(self, level):
+        """
+        Sends every request made in this thread inside the with block at
+        {level}, one of PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK.
+            with p.priority(PRIORITY_INTERACTIVE):
+                p.getSingleProduct("1234")
+        """
+        previous = getattr(_local, "priority", None)
+        _local.priority = level
+        try:
+            yield
+        finally:
+            _local.priority = previous
+
+    def _withPriority(self, level, func):
+        """
+        RETURNS func wrapped to run at {level} in whatever thread calls it,
+            for handing to a ThreadPool.
+        """
+        def wrapper(*args, **kwargs):
+            with self.priority(level):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def _hedgeDelay(self, path):
+        """
+        RETURNS the hedge_percentile latency of the endpoint, or None while
+            there are fewer than hedge_min_samples to go on
+        """
+        with BigCommerce._stats_lock:
+            latencies = sorted(BigCommerce._latencies.get(self._endpoint(path), ()))
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * self.hedge_percentile // 100)]
+
+    def _hedgedGet(self, path, params):
+        """
+        GET that sends a second, identical request if the first has not
+        answered within the endpoint's hedge delay.  The first successful
+        response is returned.
+        The delay is counted from when the first request actually goes out,
+        not from when it started waiting for the rate budget, and a hedge is
+        only sent with a spare token.  Otherwise a saturated budget would make
+        nearly every GET hedge and double the load.
+        """
+        delay = self._hedgeDelay(path)
+        if delay is None:
+            return self._request("GET", path, params=params)
+        results = Queue()
+        sent = threading.Event()
+
+        def attempt(**kwargs):
+            try:
+                results.put((True, self._request("GET", path, params=params, **kwargs)))
+            except Exception as e:
+                results.put((False, e))
+            finally:
+                # also wakes the caller if the request failed before going out
+                sent.set()
+        # the hedges run in new threads, keep the caller's priority
+        attempt = self._withPriority(self._priority(), attempt)
+
+        attempts = 1
+        threading.Thread(target=attempt, kwargs={"sent": sent}).start()
+        sent.wait()
+        try:
+            ok, value = results.get(timeout=delay)
+        except Empty:
+            limiter = self._rateLimiter()
+            if limiter is None or limiter.tryAcquire():
+                attempts += 1
+                threading.Thread(target=attempt, kwargs={"have_token": limiter is not None}).start()
+            ok, value = results.get()
+        attempts -= 1
+        while not ok and attempts:
+            ok, value = results.get()
+            attempts -= 1
+        if not ok:
+            raise value
+        return value
+
 
 class Products(BigCommerce):
+    conditions = ("New", "Used", "Refurbished")
+    availabilities = ("available", "disabled", "preorder")
+    open_graph_types = (
+                        "product", "album", "book", "drink", "food",
+                        "game", "movie", "song", "tv_show"
+                        )
+    # fields accepted by _listProducts
+    product_filter_fields = {
+                             "page": _field("int"),
+                             "limit": _field("int"),
+                             "min_id": _field("int"),
+                             "max_id": _field("int"),
+                             "name": _field("str"),
+                             "keyword_filter": _field("str"),
+                             "description": _field("str"),
+                             "sku": _field("str"),
+                             "condition": _field("str", conditions),
+                             "availability": _field("str", availabilities),
+                             "brand_id": _field("int"),
+                             "min_date_created": _field("date"),
+                             "max_date_created": _field("date"),
+                             "min_date_modified": _field("date"),
+                             "max_date_modified": _field("date"),
+                             "min_date_last_imported": _field("date"),
+                             "max_date_last_imported": _field("date"),
+                             "min_price": _field("number"),
+                             "max_price": _field("number"),
+                             "min_number_sold": _field("int"),
+                             "max_number_sold": _field("int"),
+                             "is_visible": _field("bool"),
+                             "is_featured": _field("bool"),
+                             "min_inventory_level": _field("int"),
+                             "max_inventory_level": _field("int"),
+                             "include_sku": _field("bool"),
+                             "category": _field("int"),
+                             "product_tax_code": _field("str")
+                             }
+    # fields accepted by updateProduct
+    product_fields = {
+                      "type_var": _field("str", ("physical", "digital"), "type"),
+                      "sku": _field("str"),
+                      "description": _field("str"),
+                      "search_keywords": _field("str"),
+                      "availability_description": _field("str"),
+                      "price": _field("number"),
+                      "cost_price": _field("number"),
+                      "retail_price": _field("number"),
+                      "sale_price": _field("number"),
+                      "calculated_price": _field("number"),
+                      "sort_order": _field("int"),
+                      "is_visible": _field("bool"),
+                      "is_featured": _field("bool"),
+                      "related_products": _field("any"),
+                      "inventory_level": _field("int"),
+                      "inventory_warning_level": _field("int"),
+                      "warranty": _field("str"),
+                      "weight": _field("number"),
+                      "width": _field("number"),
+                      "height": _field("number"),
+                      "depth": _field("number"),
+                      "fixed_cost_shipping_price": _field("number"),
+                      "is_free_shipping": _field("bool"),
+                      "inventory_tracking": _field("str", ("none", "simple", "sku")),
+                      "rating_total": _field("int"),
+                      "rating_count": _field("int"),
+                      "total_sold": _field("int"),
+                      "date_created": _field("date"),
+                      "brand_id": _field("int"),
+                      "view_count": _field("int"),
+                      "page_title": _field("str"),
+                      "meta_keywords": _field("any"),
+                      "meta_description": _field("str"),
+                      "layout_file": _field("str"),
+                      "is_price_hidden": _field("bool"),
+                      "price_hidden_label": _field("str"),
+                      "categories": _field("list"),
+                      "date_modified": _field("date"),
+                      "event_date_field_name": _field("str"),
+                      "event_date_type": _field("str", ("none", "after", "before", "range")),
+                      "event_date_start": _field("date"),
+                      "event_date_end": _field("date"),
+                      "myob_asset_account": _field("str"),
+                      "myob_income_account": _field("str"),
+                      "myob_expense_account": _field("str"),
+                      "peachtree_gl_account": _field("str"),
+                      "condition": _field("str", conditions),
+                      "is_condition_known": _field("bool"),
+                      "preorder_release_date": _field("date"),
+                      "is_preorder_only": _field("bool"),
+                      "preorder_message": _field("str"),
+                      "order_quantity_minimum": _field("int"),
+                      "order_quantity_maximum": _field("int"),
+                      "open_graph_type": _field("str", open_graph_types),
+                      "open_graph_title": _field("str"),
+                      "open_graph_description": _field("str"),
+                      "is_open_graph_thumbnail": _field("bool"),
+                      "upc": _field("str"),
+                      "date_last_imported": _field("date"),
+                      "option_set_id": _field("int"),
+                      "tax_class_id": _field("int"),
+                      "option_set_display": _field("str", ("right", "below")),
+                      "bin_picking_number": _field("str"),
+                      "custom_url": _field("str"),
+                      "availability": _field("str", availabilities),
+                      "brand": _field("any"),
+                      "downloads": _field("any"),
+                      "images": _field("any"),
+                      "discount_rules": _field("any"),
+                      "configurable_fields": _field("any"),
+                      "custom_fields": _field("any"),
+                      "videos": _field("any"),
+                      "skus": _field("any"),
+                      "rules": _field("any"),
+                      "option_set": _field("any"),
+                      "options": _field("any"),
+                      "tax_class": _field("any"),
+                      "avalara_product_tax_code": _field("str")
+                      }
 
     def __init__(self, debug=False):
         """
@@ -131,7 +981,8 @@ class Products(BigCommerce):
                       max_inventory_level=None,
                       include_sku=None,
                       category=None,
-                      product_tax_code=None
+                      product_tax_code=None,
+                      stream=False
                       ):
         """
         REFERENCE -> https://developer.bigcommerce.com/api/stores/v2/products
@@ -140,76 +991,174 @@ class Products(BigCommerce):
         RETURNS   -> the request response which contains the json dictionary (r.json)
         __VARIABLES__
         refer to url reference for descriptions of the variables
+        stream -> leave the body unread so it can be parsed with _iterJSONArray.
+            Streamed requests are not coalesced, and the caller records the
+            outcome on the endpoint's circuit breaker, see _streamProductPage.
         """
         # print("Running _listProducts Function.")
         path = self.path
-        payload = {"page": page, "limit": limit}
-        # conditionally add filters if filter is not None
-        if min_id is not None: payload["min_id"] = min_id
-        if max_id is not None: payload["max_id"] = max_id
-        if name is not None: payload["name"] = name
-        if keyword_filter is not None: payload["keyword_filter"] = keyword_filter
-        if description is not None: payload["description"] = description
-        if sku is not None: payload["sku"] = str(sku)
-        if condition is not None: payload["condition"] = condition
-        if availability is not None: payload["availability"] = availability
-        if brand_id is not None: payload["brand_id"] = brand_id
-        if min_date_created is not None: payload["min_date_created"] = min_date_created
-        if max_date_created is not None: payload["max_date_created"] = max_date_created
-        if min_date_modified is not None: payload["min_date_modified"] = min_date_modified
-        if max_date_modified is not None: payload["max_date_modified"] = max_date_modified
-        if min_date_last_imported is not None: payload["min_date_last_imported"] = min_date_last_imported
-        if max_date_last_imported is not None: payload["max_date_last_imported"] = max_date_last_imported
-        if min_price is not None: payload["min_price"] = min_price
-        if max_price is not None: payload["max_price"] = max_price
-        if min_number_sold is not None: payload["min_number_sold"] = min_number_sold
-        if max_number_sold is not None: payload["max_number_sold"] = max_number_sold
-        if is_visible is not None: payload["is_visible"] = is_visible
-        if is_featured is not None: payload["is_featured"] = is_featured
-        if min_inventory_level is not None: payload["min_inventory_level"] = min_inventory_level
-        if max_inventory_level is not None: payload["max_inventory_level"] = max_inventory_level
-        if include_sku is not None: payload["include_sku"] = include_sku
-        if category is not None: payload["category"] = category
-        if product_tax_code is not None: payload["product_tax_code"] = product_tax_code
+        payload = self._buildPayload(self.product_filter_fields, locals())
         print("Requesting {} items on page {}.".format(limit, page))
         # print(path)
         # print(self.headers)
         # print(payload)
         # print(path)
-        r = requests.get(url=path, headers=self.headers, params=payload)
+        if stream:
+            return self._request("GET", path, params=payload, stream=True)
+        r = self._get(path, payload)
         if self.debug:
             print(r.text)
         return r
 
-    def getAllProducts(self):
+    def _streamProductPage(self, page, **filters):
+        """
+        Streams one page of products and parses it while it downloads.
+        RETURNS   -> (r, items), items is a generator that is empty for 204 and
+            error responses
+        """
+        r = self._listProducts(page=page, stream=True, **filters)
+        if r.status_code == 204 or not str(r.status_code).startswith("2"):
+            if r.status_code < 500:
+                self._breaker(self.path).record(True)
+            r.close()
+            return r, iter(())
+        return r, self._iterPageItems(r, self._priority(), page, filters)
+
+    def _iterPageItems(self, r, level, page, filters):
+        """
+        Yields the items of a streamed page.  A connection error, read timeout
+        or broken body counts as a failure on the endpoint's circuit breaker,
+        and the page is fetched again at priority {level}, skipping the items
+        already handed out, up to max_retries times.
+        """
+        breaker = self._breaker(self.path)
+        count = 0
+        retries = 0
+        while True:
+            try:
+                for item in itertools.islice(_iterJSONArray(r), count, None):
+                    count += 1
+                    yield item
+            except GeneratorExit:
+                # the caller stopped early, the body was fine up to here
+                r.close()
+                breaker.record(True)
+                raise
+            except (requests.exceptions.RequestException, ValueError):
+                r.close()
+                breaker.record(False)
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                with self.priority(level):
+                    r = self._listProducts(page=page, stream=True, **filters)
+                if r.status_code == 204 or not str(r.status_code).startswith("2"):
+                    if r.status_code < 500:
+                        breaker.record(True)
+                    r.close()
+                    self._checkStatus(r)
+                    return
+                continue
+            except Exception:
+                r.close()
+                breaker.record(False)
+                raise
+            breaker.record(True)
+            return
+
+    def _readProductPage(self, page, **filters):
+        """
+        Streams one page of products and parses it while it downloads.
+        RETURNS   -> (r, items), items is empty for 204 and error responses
+        """
+        r, items = self._streamProductPage(page, **filters)
+        return r, list(items)
+
+    def iterProducts(self, limit=250, **filters):
+        """
+        Yields every product matching the filters, one at a time.  Each page is
+        streamed and parsed incrementally, so items are handed out while the
+        rest of the page is still downloading.
+        __VARIABLES__
+        filters -> any _listProducts filter other than page
+        """
+        page = 1
+        while True:
+            # only the request itself is bulk, the caller runs between yields
+            with self.priority(PRIORITY_BULK):
+                r, items = self._streamProductPage(page, limit=limit, **filters)
+            if str(r.status_code) == "204":
+                return
+            self._checkStatus(r)
+            count = 0
+            for item in items:
+                count += 1
+                yield item
+            if count < limit:
+                return
+            page += 1
+
+    def iterProductChanges(self, tracker, complete=None, **filters):
+        """
+        Streams the catalog through a ChangeTracker.
+        complete -> whether the fetch covers the whole catalog, so products
+            missing from it are reported as removed.  Defaults to True unless
+            a filter other than limit (the page size) is given.
+        RETURNS   -> a generator of ChangeEvents for products that changed since
+            the tracker last saw them
+        """
+        if complete is None:
+            complete = not [name for name in filters if name != "limit"]
+        return tracker.track(self.iterProducts(**filters), complete=complete)
+
+    def getAllProducts(self, checkpoint_path=None, threads=8):
         """
         multithreaded
         returns a dictionary of information
             {skus}
             skus is a dictionary with many keys and values
             refer to output.txt to see what information it holds
+        checkpoint_path -> optional file to save progress to after every batch
+            of pages.  If an earlier run with the same path did not finish,
+            the crawl resumes after the highest product id it had saved, so
+            products added or deleted in the meantime don't shift it.
+        threads -> number of pages fetched at once
         """
         skus = {}
         page = 1
-        num_pages = 8
+        num_pages = threads
         r = None
         found_empty = False
+        # products are listed in id order, pages are counted from min_id on
+        min_id = None
+        last_id = None
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint = _Checkpoint(checkpoint_path)
+            min_id = checkpoint.state.get("min_id")
+            for kind, item in checkpoint.records():
+                skus[item["sku"]] = item
         pool = ThreadPool(num_pages)
         while not found_empty:
             pages = range(page, page + num_pages)
-            results = pool.map(lambda x: self._listProducts(page=x), pages)
+            results = pool.map(self._withPriority(PRIORITY_BULK, lambda x: self._readProductPage(x, min_id=min_id)), pages)
         # print(results)
-            for r in results:
+            for r, temp_data in results:
                 if str(r.status_code) == "204":
                     found_empty = True
                     break
-                if str(r.status_code).startswith("4"):
-                    raise Exception("Error {}: {}.".format(r.status_code, BigCommerce.error_codes[int(r.status_code)]))
-                temp_data = r.json()
+                self._checkStatus(r)
                 for item in temp_data:
                     sku = item["sku"]
                     skus[sku] = item
+                    last_id = item["id"] if last_id is None else max(last_id, item["id"])
+                if checkpoint is not None:
+                    checkpoint.append("product", temp_data)
                 page += 1
+            if checkpoint is not None and last_id is not None:
+                checkpoint.save(min_id=last_id + 1)
+        if checkpoint is not None:
+            checkpoint.clear()
         return {"skus": skus}
 
     def getSingleProduct(self, sku):
@@ -219,7 +1168,8 @@ class Products(BigCommerce):
         __VARIABLES__
         sku -> self explanatory
         """
-        r = self._listProducts(sku=sku)
+        with self.priority(PRIORITY_INTERACTIVE):
+            r = self._listProducts(sku=sku)
         if str(r.status_code) == "204":
             print("Sku not found.")
         elif str(r.status_code).startswith("4"):
@@ -230,6 +1180,66 @@ class Products(BigCommerce):
             item = temp_data[0]
             return item
 
+    def getProducts(self, skus, threads=8):
+        """
+        Looks up many skus concurrently, one request per sku.
+        RETURNS   -> {sku: product} keyed by the skus as given, with NOT_FOUND
+            for skus that don't exist
+        """
+        # 1234 and "1234" are the same sku, look it up once
+        keys = {}
+        for sku in skus:
+            keys.setdefault(str(sku), []).append(sku)
+        products = {}
+        if not keys:
+            return products
+        pool = ThreadPool(min(threads, len(keys)))
+        results = pool.map(self._withPriority(PRIORITY_INTERACTIVE, lambda sku: (sku, self._listProducts(sku=sku))), list(keys))
+        pool.close()
+        for sku, r in results:
+            self._checkStatus(r)
+            product = NOT_FOUND
+            if r.status_code != 204:
+                for item in r.json():
+                    if str(item["sku"]) == sku:
+                        product = item
+            for key in keys[sku]:
+                products[key] = product
+        return products
+
+    def getProductsById(self, ids, threads=8):
+        """
+        Looks up many product ids concurrently.  Dense ids are fetched by
+        listing the id range 250 at a time, sparse ids one request each.
+        RETURNS   -> {id (int): product} with NOT_FOUND for ids that don't exist
+        """
+        ids = sorted(set(int(id) for id in ids))
+        products = dict((id, NOT_FOUND) for id in ids)
+        if not ids:
+            return products
+        span = ids[-1] - ids[0] + 1
+        # listing downloads every product in the range, so only do it when
+        # at least half of the range was asked for
+        if span <= 2 * len(ids):
+            pages = range(1, (span + 249) // 250 + 1)
+            pool = ThreadPool(min(threads, len(pages)))
+            results = pool.map(self._withPriority(PRIORITY_INTERACTIVE, lambda page: self._readProductPage(page, min_id=ids[0], max_id=ids[-1])), pages)
+            pool.close()
+            for r, items in results:
+                self._checkStatus(r)
+                for item in items:
+                    if item["id"] in products:
+                        products[item["id"]] = item
+            return products
+        pool = ThreadPool(min(threads, len(ids)))
+        results = pool.map(self._withPriority(PRIORITY_INTERACTIVE, lambda id: (id, self._get(self.path + str(id)))), ids)
+        pool.close()
+        for id, r in results:
+            self._checkStatus(r, allowed=(404,))
+            if r.status_code != 404:
+                products[id] = r.json()
+        return products
+
     def listProductImages(self, id, page=1, limit=250):
         """
         REFERENCE -> https://developer.bigcommerce.com/api/stores/v2/products/images
@@ -238,7 +1248,7 @@ class Products(BigCommerce):
         path = "{}{}/images".format(self.path, id)
         # print(path)
         payload = {"page": page, "limit": limit}
-        r = requests.get(url=path, headers=self.headers, params=payload)
+        r = self._get(path, payload)
         return r
 
     def createProductImage(self, id, image_file):
@@ -248,7 +1258,7 @@ class Products(BigCommerce):
         path = "{}{}/images".format(self.path, id)
         data = {}
         data["image_file"] = image_file
-        r = requests.post(path, data=json.dumps(data), headers=self.headers)
+        r = self._request("POST", path, data=json.dumps(data))
         if self.debug:
             print(r.text)
         return r
@@ -261,7 +1271,7 @@ class Products(BigCommerce):
         data = {}
         data["image_file"] = image_file
         if sort_order is not None: data["sort_order"] = sort_order
-        r = requests.put(path, data=json.dumps(data), headers=self.headers)
+        r = self._request("PUT", path, data=json.dumps(data))
         if self.debug:
             print(r.text)
         return r
@@ -355,91 +1365,143 @@ class Products(BigCommerce):
         Updates products based on given arguments
         """
         path = self.path + str(id)
-        data = {}
-        if type_var is not None: data["type"] = type_var
-        if sku is not None: data["sku"] = sku
-        if description is not None: data["description"] = description
-        if search_keywords is not None: data["search_keywords"] = search_keywords
-        if availability_description is not None: data["availability_description"] = availability_description
-        if price is not None: data["price"] = price
-        if cost_price is not None: data["cost_price"] = cost_price
-        if retail_price is not None: data["retail_price"] = retail_price
-        if sale_price is not None: data["sale_price"] = sale_price
-        if calculated_price is not None: data["calculated_price"] = calculated_price
-        if sort_order is not None: data["sort_order"] = sort_order
-        if is_visible is not None: data["is_visible"] = is_visible
-        if is_featured is not None: data["is_featured"] = is_featured
-        if related_products is not None: data["related_products"] = related_products
-        if inventory_level is not None: data["inventory_level"] = inventory_level
-        if inventory_warning_level is not None: data["inventory_warning_level"] = inventory_warning_level
-        if warranty is not None: data["warranty"] = warranty
-        if weight is not None: data["weight"] = weight
-        if width is not None: data["width"] = width
-        if height is not None: data["height"] = height
-        if depth is not None: data["depth"] = depth
-        if fixed_cost_shipping_price is not None: data["fixed_cost_shipping_price"] = fixed_cost_shipping_price  # OMG OVER 70 CHARACTERS PEP8 ME I DARE YOU
-        if is_free_shipping is not None: data["is_free_shipping"] = is_free_shipping
-        if inventory_tracking is not None: data["inventory_tracking"] = inventory_tracking
-        if rating_total is not None: data["rating_total"] = rating_total
-        if rating_count is not None: data["rating_count"] = rating_count
-        if total_sold is not None: data["total_sold"] = total_sold
-        if date_created is not None: data["date_created"] = date_created
-        if brand_id is not None: data["brand_id"] = brand_id
-        if view_count is not None: data["view_count"] = view_count
-        if page_title is not None: data["page_title"] = page_title
-        if meta_keywords is not None: data["meta_keywords"] = meta_keywords
-        if meta_description is not None: data["meta_description"] = meta_description
-        if layout_file is not None: data["layout_file"] = layout_file
-        if is_price_hidden is not None: data["is_price_hidden"] = is_price_hidden
-        if price_hidden_label is not None: data["price_hidden_label"] = price_hidden_label
-        if categories is not None: data["categories"] = categories
-        if date_modified is not None: data["date_modified"] = date_modified
-        if event_date_field_name is not None: data["event_date_field_name"] = event_date_field_name
-        if event_date_type is not None: data["event_date_type"] = event_date_type
-        if event_date_start is not None: data["event_date_start"] = event_date_start
-        if event_date_end is not None: data["event_date_end"] = event_date_end
-        if myob_asset_account is not None: data["myob_asset_account"] = myob_asset_account
-        if myob_income_account is not None: data["myob_income_account"] = myob_income_account
-        if myob_expense_account is not None: data["myob_expense_account"] = myob_expense_account
-        if peachtree_gl_account is not None: data["peachtree_gl_account"] = peachtree_gl_account
-        if condition is not None: data["condition"] = condition
-        if is_condition_known is not None: data["is_condition_known"] = is_condition_known
-        if preorder_release_date is not None: data["preorder_release_date"] = preorder_release_date
-        if is_preorder_only is not None: data["is_preorder_only"] = is_preorder_only
-        if preorder_message is not None: data["preorder_message"] = preorder_message
-        if order_quantity_minimum is not None: data["order_quantity_minimum"] = order_quantity_minimum
-        if order_quantity_maximum is not None: data["order_quantity_maximum"] = order_quantity_maximum
-        if open_graph_type is not None: data["open_graph_type"] = open_graph_type
-        if open_graph_title is not None: data["open_graph_title"] = open_graph_title
-        if open_graph_description is not None: data["open_graph_description"] = open_graph_description
-        if is_open_graph_thumbnail is not None: data["is_open_graph_thumbnail"] = is_open_graph_thumbnail
-        if upc is not None: data["upc"] = upc
-        if date_last_imported is not None: data["date_last_imported"] = date_last_imported
-        if option_set_id is not None: data["option_set_id"] = option_set_id
-        if tax_class_id is not None: data["tax_class_id"] = tax_class_id
-        if option_set_display is not None: data["option_set_display"] = option_set_display
-        if bin_picking_number is not None: data["bin_picking_number"] = bin_picking_number
-        if custom_url is not None: data["custom_url"] = custom_url
-        if availability is not None: data["availability"] = availability
-        if brand is not None: data["brand"] = brand
-        if downloads is not None: data["downloads"] = downloads
-        if images is not None: data["images"] = images
-        if discount_rules is not None: data["discount_rules"] = discount_rules
-        if configurable_fields is not None: data["configurable_fields"] = configurable_fields
-        if custom_fields is not None: data["custom_fields"] = custom_fields
-        if videos is not None: data["videos"] = videos
-        if skus is not None: data["skus"] = skus
-        if rules is not None: data["rules"] = rules
-        if option_set is not None: data["option_set"] = option_set
-        if options is not None: data["options"] = options
-        if tax_class is not None: data["tax_class"] = tax_class
-        if avalara_product_tax_code is not None: data["avalara_product_tax_code"] = avalara_product_tax_code
+        data = self._buildPayload(self.product_fields, locals())
         print("Updating id {}.".format(id))
-        r = requests.put(path, data=json.dumps(data), headers=self.headers)
+        r = self._request("PUT", path, data=json.dumps(data))
         if self.debug:
             print(r.text)
         return r
 
+    def _catalogIndex(self, fields):
+        """
+        Streams the whole catalog into a compact lookup table.
+        RETURNS   -> {sku: (id, (value of each of fields))}
+        """
+        index = {}
+        for item in self.iterProducts():
+            index[str(item["sku"])] = (item["id"], tuple(item.get(field) for field in fields))
+        return index
+
+    def importFeed(
+                   self,
+                   feed_path,
+                   fields=("inventory_level", "price"),
+                   sku_column="sku",
+                   chunk_size=1000,
+                   threads=8,
+                   dry_run=False,
+                   index=None,
+                   report_path=None
+                   ):
+        """
+        Pushes a supplier feed to the store.  The feed is streamed {chunk_size}
+        rows at a time and joined by sku against an index of the catalog.  Only
+        rows where one of {fields} differs from the store become updateProduct
+        calls, sent {threads} at a time.
+        __VARIABLES__
+        feed_path   -> csv file, json lines if it ends in .jsonl or a json
+                       array if it ends in .json.  Columns are named like the
+                       product fields.
+        index       -> catalog index from _catalogIndex(fields), fetched if None.
+                       It is kept up to date with the updates sent.
+        dry_run     -> work out and validate the updates without sending them
+        report_path -> optional csv with one line per changed or failed sku
+        RETURNS   -> {
+                      "updates": [{"sku", "id", "changes": {field: [old, new]}, "status"}],
+                      "unchanged": number of rows that already matched the store,
+                      "not_found": skus that are not in the catalog,
+                      "failed": [{"sku", "error"}], sku is None for rows without one
+                      }
+            When a chunk has several rows for one sku, only the last is used.
+            status is the response status code, or "dry run"
+        """
+        fields = tuple(fields)
+        if index is None:
+            index = self._catalogIndex(fields)
+        report = {"updates": [], "unchanged": 0, "not_found": [], "failed": []}
+
+        def send(update):
+            values = dict((field, new) for field, (old, new) in update["changes"].items())
+            try:
+                return self.updateProduct(update["id"], **values).status_code, None
+            except Exception as e:
+                return None, repr(e)
+        send = self._withPriority(PRIORITY_BULK, send)
+        pool = ThreadPool(threads)
+        for rows in _chunks(_iterFeed(feed_path), chunk_size):
+            # the last row for a sku wins, two rows for one sku must not be
+            # sent as two racing PUTs to the same product
+            latest = OrderedDict()
+            for row in rows:
+                sku = row.get(sku_column) if isinstance(row, dict) else None
+                if sku is None or sku == "":
+                    report["failed"].append({"sku": None, "error": "Row without {}: {!r}".format(sku_column, row)})
+                    continue
+                latest.pop(str(sku), None)
+                latest[str(sku)] = row
+            updates = []
+            for sku, row in latest.items():
+                if sku not in index:
+                    report["not_found"].append(sku)
+                    continue
+                id, current = index[sku]
+                changes = {}
+                for field, old in zip(fields, current):
+                    new = row.get(field)
+                    if new is not None and new != "" and not _sameValue(old, new):
+                        changes[field] = [old, new]
+                if not changes:
+                    report["unchanged"] += 1
+                    continue
+                try:
+                    self._buildPayload(self.product_fields, dict((field, new) for field, (old, new) in changes.items()))
+                except ValueError as e:
+                    report["failed"].append({"sku": sku, "error": str(e)})
+                    continue
+                # send "40" from a csv as 40, " 12.50" as "12.50"
+                for field, change in changes.items():
+                    change[1] = _feedValue(self.product_fields.get(field, _field("any"))[0], change[1])
+                updates.append({"sku": sku, "id": id, "changes": changes, "status": "dry run"})
+            if not dry_run:
+                for update, (status, error) in zip(updates, pool.map(send, updates)):
+                    update["status"] = status
+                    if error is not None or not str(status).startswith("2"):
+                        report["failed"].append({"sku": update["sku"], "error": error or "Error {}".format(status)})
+                updates = [update for update in updates if str(update["status"]).startswith("2")]
+            for update in updates:
+                id, current = index[update["sku"]]
+                index[update["sku"]] = (id, tuple(
+                                                  update["changes"][field][1] if field in update["changes"] else value
+                                                  for field, value in zip(fields, current)
+                                                  ))
+            report["updates"].extend(updates)
+        pool.close()
+        if report_path is not None:
+            self._writeFeedReport(report_path, report)
+        return report
+
+    @staticmethod
+    def _writeFeedReport(report_path, report):
+        if sys.version_info[0] < 3:
+            f = open(report_path, "wb")
+        else:
+            f = open(report_path, "w", newline="")
+        with f:
+            writer = csv.DictWriter(f, fieldnames=["sku", "id", "field", "old", "new", "status"])
+            writer.writeheader()
+            for update in report["updates"]:
+                for field, (old, new) in sorted(update["changes"].items()):
+                    writer.writerow({
+                                     "sku": update["sku"],
+                                     "id": update["id"],
+                                     "field": field,
+                                     "old": old,
+                                     "new": new,
+                                     "status": update["status"]
+                                     })
+            for failure in report["failed"]:
+                writer.writerow({"sku": failure["sku"], "status": failure["error"]})
+
     #######################
     # END Product Methods #
     #######################
@@ -465,10 +1527,10 @@ class Products(BigCommerce):
                 "type": type_var,
                 "type_value": int(type_value)
                 }
-        r = requests.post(
+        r = self._request(
+                          "POST",
                           path,
-                          data=json.dumps(data),
-                          headers=self.headers
+                          data=json.dumps(data)
                           )
         if self.debug:
             print(r.text)
@@ -482,10 +1544,28 @@ class Products(BigCommerce):
 class Orders(BigCommerce):
     transactions_data_path = "transactions/bctransactions.csv"
     backup_path = "transactions/bctransactionsbackup.csv"
+    # fields accepted by listOrders
+    order_filter_fields = {
+                           "page": _field("int"),
+                           "limit": _field("int"),
+                           "sort": _field("str"),
+                           "min_id": _field("int"),
+                           "max_id": _field("int"),
+                           "min_total": _field("number"),
+                           "max_total": _field("number"),
+                           "customer_id": _field("int"),
+                           "status_id": _field("int"),
+                           "is_deleted": _field("bool"),
+                           "payment_method": _field("str"),
+                           "min_date_created": _field("date"),
+                           "max_date_created": _field("date"),
+                           "min_date_modified": _field("date"),
+                           "max_date_modified": _field("date")
+                           }
 
     def __init__(self, debug=False):
         self.debug = debug
-        super(Products, self).__init__()
+        super(Orders, self).__init__()
         self.path = self.path + "orders/"
 
     def listOrders(
@@ -509,26 +1589,31 @@ class Orders(BigCommerce):
         """
         """
         path = self.path
-        payload = {"page": page, "limit": limit}
-        if sort is not None: payload["sort"] = sort
-        if min_id is not None: payload["min_id"] = min_id
-        if max_id is not None: payload["max_id"] = max_id
-        if min_total is not None: payload["min_total"] = min_total
-        if max_total is not None: payload["max_total"] = max_total
-        if customer_id is not None: payload["customer_id"] = customer_id
-        if status_id is not None: payload["status_id"] = status_id
-        if is_deleted is not None: payload["is_deleted"] = is_deleted
-        if payment_method is not None: payload["payment_method"] = payment_method
-        if min_date_created is not None: payload["min_date_created"] = min_date_created
-        if max_date_created is not None: payload["max_date_created"] = max_date_created
-        if min_date_modified is not None: payload["min_date_modified"] = min_date_modified
-        if max_date_modified is not None: payload["max_date_modified"] = max_date_modified
+        payload = self._buildPayload(self.order_filter_fields, locals())
         print("Requesting {} orders on page {}".format(limit, page))
-        r = requests.get(path, params=payload, headers=self.headers)
+        r = self._get(path, payload)
         if self.debug:
             print(r.text)
         return r
 
+    def iterOrders(self, **filters):
+        """
+        Yields every order matching the filters, one page at a time.
+        __VARIABLES__
+        filters -> any listOrders filter other than page
+        """
+        page = 1
+        while True:
+            # only the request itself is bulk, the caller runs between yields
+            with self.priority(PRIORITY_BULK):
+                r = self.listOrders(page=page, **filters)
+            if r.status_code == 204:
+                return
+            self._checkStatus(r)
+            for order in r.json():
+                yield order
+            page += 1
+
     def listOrderProducts(self, order_id, page=1, limit=250):
         """
         REFERENCE -> https://developer.bigcommerce.com/api/stores/v2/orders/products
@@ -539,35 +1624,70 @@ class Orders(BigCommerce):
         path = "{}{}/products".format(self.path, order_id)
         payload = {"page": page, "limit": limit}
         print("Requesting {} products on page {} for order {}".format(limit, page, order_id))
-        r = requests.get(path, params=payload, headers=self.headers)
+        r = self._get(path, payload)
         if self.debug:
             print(r.text)
         return r
 
-    def getAllTransactions(self, num_transactions=500):
+    def getAllTransactions(self, num_transactions=500, checkpoint_path=None, threads=1):
         """
+        returns a dictionary of every product line of every order, keyed by id
+        checkpoint_path -> optional file to save progress to after every page
+            of orders and every batch of orders' products.  If an earlier run
+            with the same path did not finish, the crawl resumes where it stopped.
+        threads -> number of orders whose products are fetched at once
         """
         o = {}
         t = {}
         r = None
         page = 1
-        while r is None or r.status_code != 204:
-            r = self.listOrders(page=page)
+        orders_listed = False
+        done = set()
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint = _Checkpoint(checkpoint_path)
+            page = checkpoint.state.get("page", 1)
+            orders_listed = checkpoint.state.get("orders_listed", False)
+            for kind, record in checkpoint.records():
+                if kind == "order":
+                    o[record["id"]] = record
+                elif kind == "transaction":
+                    t[record["id"]] = record
+                elif kind == "done":
+                    done.add(record)
+        while not orders_listed:
+            with self.priority(PRIORITY_BULK):
+                r = self.listOrders(page=page)
+            # a failed page must not be saved as done, or a resume skips it
+            self._checkStatus(r, allowed=(204,))
             page += 1
-            try:
-                orders = r.json()
-                for order in orders:
-                    order_id = order["id"]
-                    o[order_id] = order
-            except:
-                pass
-        # get products from orders
-        for order in o:
-            items = self.listOrderProducts(order).json()
-            # print(items)
-            for item in items:
-                t_id = item["id"]
-                t[t_id] = item
+            orders_listed = r.status_code == 204
+            orders = [] if orders_listed else r.json()
+            for order in orders:
+                order_id = order["id"]
+                o[order_id] = order
+            if checkpoint is not None:
+                checkpoint.append("order", orders)
+                checkpoint.save(page=page, orders_listed=orders_listed)
+        # get products from orders, {threads} orders at a time
+        pending = [order for order in o if order not in done]
+        pool = ThreadPool(threads)
+        for i in range(0, len(pending), threads):
+            batch = pending[i:i + threads]
+            results = pool.map(self._withPriority(PRIORITY_BULK, lambda order: self.listOrderProducts(order).json()), batch)
+            for order, items in zip(batch, results):
+                # print(items)
+                for item in items:
+                    t_id = item["id"]
+                    t[t_id] = item
+                if checkpoint is not None:
+                    checkpoint.append("transaction", items)
+                    checkpoint.append("done", [order])
+            if checkpoint is not None:
+                checkpoint.save(page=page, orders_listed=True)
+        pool.close()
+        if checkpoint is not None:
+            checkpoint.clear()
         return t
 
     def getOldTransactions(self):
@@ -600,12 +1720,13 @@ class Orders(BigCommerce):
                              }
         return old_t
 
-    def saveTransactions(self, num_transactions=500):
+    def saveTransactions(self, num_transactions=500, checkpoint_path=None, threads=1):
         """
         returns unseen transactions and writes the last 5000 transactions to a spreadsheet.
+        checkpoint_path and threads are passed on to getAllTransactions.
         """
         old_t = self.getOldTransactions()
-        new_t = self.getAllTransactions()
+        new_t = self.getAllTransactions(checkpoint_path=checkpoint_path, threads=threads)
         new_trans = {}
         for t in new_t:
             if str(t) not in old_t:
@@ -685,7 +1806,7 @@ class Orders(BigCommerce):
     def listShipments(self, order_id, page=1, limit=50):
         path = "{}{}/shipments".format(self.path, order_id)
         payload = {"page": str(page), "limit": str(limit)}
-        r = requests.get(path, headers=self.headers, params=payload)
+        r = self._get(path, payload)
         print(r.status_code)
         return r
 
@@ -698,11 +1819,12 @@ class Orders(BigCommerce):
         Only works on packages that have already been marked as shipped 
             and "ship items" has been clicked.
         """
-        sid = self.getShipmentId(order_id)
-        path = self.path + str(order_id) + "/shipments/" + str(sid)
-        print(path)
-        data = {"tracking_number": str(tracking_number)}
-        r = requests.put(path, data=json.dumps(data), headers=self.headers)
+        with self.priority(PRIORITY_INTERACTIVE):
+            sid = self.getShipmentId(order_id)
+            path = self.path + str(order_id) + "/shipments/" + str(sid)
+            print(path)
+            data = {"tracking_number": str(tracking_number)}
+            r = self._request("PUT", path, data=json.dumps(data))
         return r
 
     def createShipment(self):
@@ -712,7 +1834,7 @@ class Orders(BigCommerce):
 class Content(BigCommerce):
 
     def __init__(self):
-        super(Products, self).__init__()
+        super(Content, self).__init__()
 
     def createABlog(self, title, body, author=None, tags=None):
         """
@@ -732,14 +1854,14 @@ class Content(BigCommerce):
         data["body"] = body
         if author is not None: data["author"] = author
         if tags is not None: data["tags"] = str(tags)
-        r = requests.post(self.path, headers=self.headers, data=data)
+        r = self._request("POST", self.path, data=data)
         return r
 
 
 class Customers(BigCommerce):
 
     def __init__(self):
-        super(Products, self).__init__()
+        super(Customers, self).__init__()
         self.path = self.path + "customer_groups/"
 
     def listCustomerGroups(self, name=None, is_default=None, page=1, limit=50):
@@ -747,7 +1869,7 @@ class Customers(BigCommerce):
         payload = {"page": page, "limit": limit}
         if name is not None: payload["name"] = name
         if is_default is not None: payload["is_default"] = is_default
-        r = requests.get(path, headers=self.headers, params=payload)
+        r = self._get(path, payload)
         return r
 
     def getWholesaleID(self):
@@ -765,10 +1887,152 @@ class Customers(BigCommerce):
         data -> put request data
         """
         path = self.path + str(id)
-        r = requests.put(path, data=data, headers=self.headers)
+        r = self._request("PUT", path, data=data)
         return r
 
 
+ChangeEvent = namedtuple("ChangeEvent", ["kind", "key", "field", "value"])
+
+
+class ChangeTracker(object):
+    """
+    Change data capture between catalog snapshots.
+    Only a fingerprint is kept per record (a crc32 of each watched field), and
+    new fetches are compared against it as they stream in.
+    __VARIABLES__
+    fields -> the record fields to watch
+    key    -> the field that identifies a record
+    path   -> optional json file the fingerprints are loaded from and saved to
+              so changes are tracked between runs
+    Events are ChangeEvent(kind, key, field, value) with kind one of
+        "added"   -> value is the new record, field is None
+        "changed" -> field changed, value is its new value
+        "removed" -> field and value are None
+    """
+    default_fields = ("price", "sale_price", "inventory_level", "is_visible", "availability")
+
+    def __init__(self, fields=default_fields, key="sku", path=None):
+        self.fields = tuple(fields)
+        self.key = key
+        self.path = path
+        self.fingerprints = {}
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            # fingerprints of other fields can't be compared, start over
+            if tuple(state["fields"]) == self.fields and state["key"] == key:
+                self.fingerprints = dict((k, tuple(v)) for k, v in state["fingerprints"])
+
+    def _fingerprint(self, record):
+        return tuple(
+                     zlib.crc32(json.dumps(record.get(field), sort_keys=True).encode("utf-8")) & 0xffffffff
+                     for field in self.fields
+                     )
+
+    def track(self, records, complete=True):
+        """
+        Yields a ChangeEvent for every added record, changed field and removed
+        record, updating the fingerprints as it goes.
+        complete -> records is the whole catalog.  Removals can only be known
+            once records is exhausted, so they come last.  Pass False for a
+            filtered fetch, which never reports removals.
+        """
+        seen = set()
+        for record in records:
+            key = record[self.key]
+            seen.add(key)
+            new = self._fingerprint(record)
+            old = self.fingerprints.get(key)
+            if old is None:
+                yield ChangeEvent("added", key, None, record)
+            elif old != new:
+                for field, old_hash, new_hash in zip(self.fields, old, new):
+                    if old_hash != new_hash:
+                        yield ChangeEvent("changed", key, field, record.get(field))
+            self.fingerprints[key] = new
+        if complete:
+            for key in [k for k in self.fingerprints if k not in seen]:
+                del self.fingerprints[key]
+                yield ChangeEvent("removed", key, None, None)
+        if self.path is not None:
+            self.save()
+
+    def save(self):
+        _writeJSON(self.path, {
+                               "fields": self.fields,
+                               "key": self.key,
+                               "fingerprints": list(self.fingerprints.items())
+                               })
+
+
+class SyncDaemon(object):
+    """
+    Runs sync jobs on a schedule in one long-lived process.  Connection pools,
+    the bc.data cache, latency stats and circuit breakers are shared by every
+    run instead of being rebuilt by each cron invocation.
+    Results of the last successful run of each job are kept in self.results.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.results = {}
+        self._stop = threading.Event()
+
+    def addJob(self, name, func, interval):
+        """
+        name     -> shown in log lines and used as the key in self.results
+        func     -> called with no arguments on every run
+        interval -> seconds between the starts of two runs.  A run that takes
+            longer delays the next one instead of overlapping it.
+        """
+        self.jobs.append({
+                          "name": name,
+                          "func": func,
+                          "interval": interval,
+                          "next_run": time.time(),
+                          "thread": None
+                          })
+
+    def _runJob(self, job):
+        start = time.time()
+        print("Starting job {}.".format(job["name"]))
+        try:
+            self.results[job["name"]] = job["func"]()
+        except Exception as e:
+            print("Job {} failed: {!r}".format(job["name"], e))
+        else:
+            print("Finished job {} in {:.1f}s.".format(job["name"], time.time() - start))
+
+    def run(self, once=False):
+        """
+        Runs jobs as they come due, each in its own thread, until stop() is
+        called.  once -> run every job a single time and return.
+        """
+        if not self.jobs:
+            raise ValueError("SyncDaemon has no jobs to run, add some with addJob.")
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                for job in self.jobs:
+                    running = job["thread"] is not None and job["thread"].is_alive()
+                    if not running and job["next_run"] <= now:
+                        job["next_run"] = now + job["interval"]
+                        job["thread"] = threading.Thread(target=self._runJob, args=(job,))
+                        job["thread"].daemon = True
+                        job["thread"].start()
+                if once:
+                    for job in self.jobs:
+                        job["thread"].join()
+                    return
+                next_run = min(job["next_run"] for job in self.jobs)
+                self._stop.wait(max(1, next_run - time.time()))
+        except KeyboardInterrupt:
+            print("Stopping.")
+
+    def stop(self):
+        self._stop.set()
+
+
 def testclasses():
     print(Products.path)
 
@@ -876,7 +2140,76 @@ def testUpdateProductImage():
     # print(r.headers)
 
 
+def main(argv):
+    """
+    Command line entry point.
+    python bigcommerce.py daemon --products 600 --transactions 900
+        syncs products every 10 minutes and transactions every 15, see --help
+    """
+    parser = argparse.ArgumentParser(prog="bigcommerce.py")
+    commands = parser.add_subparsers(dest="command")
+    daemon_parser = commands.add_parser("daemon", help="run scheduled sync jobs")
+    daemon_parser.add_argument("--products", type=int, metavar="SECONDS",
+                               help="sync all products every SECONDS")
+    daemon_parser.add_argument("--products-threads", type=int, default=8)
+    daemon_parser.add_argument("--orders", type=int, metavar="SECONDS",
+                               help="sync orders modified since the last run every SECONDS")
+    daemon_parser.add_argument("--transactions", type=int, metavar="SECONDS",
+                               help="save new transactions every SECONDS")
+    daemon_parser.add_argument("--transactions-threads", type=int, default=1)
+    daemon_parser.add_argument("--once", action="store_true",
+                               help="run every job once and exit")
+    args = parser.parse_args(argv)
+    daemon = SyncDaemon()
+    if args.products:
+        products = Products()
+        tracker = ChangeTracker(path="products.fingerprints")
+
+        def syncProducts():
+            skus = products.getAllProducts(
+                                           checkpoint_path="products.checkpoint",
+                                           threads=args.products_threads
+                                           )["skus"]
+            # only counts are kept, the resident process must not hold on to
+            # copies of the catalog between runs
+            counts = {"products": len(skus), "added": 0, "changed": 0, "removed": 0}
+            for event in tracker.track(skus.values()):
+                counts[event.kind] += 1
+            print("{products} products, {added} added, {changed} changed, {removed} removed.".format(**counts))
+            return counts
+        daemon.addJob("products", syncProducts, args.products)
+    if args.orders:
+        orders = Orders()
+        last_sync = {"date": None}
+
+        def syncOrders():
+            started = formatdate(usegmt=True)
+            # an order can move between pages while they are listed, count it once
+            modified = set(order["id"] for order in orders.iterOrders(min_date_modified=last_sync["date"]))
+            last_sync["date"] = started
+            print("{} orders modified.".format(len(modified)))
+            return {"modified": len(modified)}
+        daemon.addJob("orders", syncOrders, args.orders)
+    if args.transactions:
+        transactions = Orders()
+
+        def syncTransactions():
+            new = transactions.saveTransactions(
+                                                checkpoint_path="transactions.checkpoint",
+                                                threads=args.transactions_threads
+                                                )
+            print("{} new transactions.".format(len(new)))
+            return {"new": len(new)}
+        daemon.addJob("transactions", syncTransactions, args.transactions)
+    if not daemon.jobs:
+        parser.error("no jobs scheduled")
+    daemon.run(once=args.once)
+    return 0
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
     # testclasses()
     # testCreateBulkPricingRule()
     # testListProducts()
@@ -0,0 +1,515 @@
+"""
+Offline tests for the parts of bigcommerce.py that don't talk to the api.
+Run with: python -m unittest test_bigcommerce
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from email.utils import formatdate
+
+import requests
+
+import bigcommerce
+
+
+class FakeResponse(object):
+    """
+    Stands in for a streamed requests response, handing out body in
+    chunks of {size} characters.  With {fail_at} set the connection drops
+    once that many characters have been read.
+    """
+
+    def __init__(self, body, size, status_code=200, fail_at=None):
+        self.body = body
+        self.size = size
+        self.status_code = status_code
+        self.fail_at = fail_at
+        self.encoding = "utf-8"
+        self.closed = False
+
+    def iter_content(self, chunk_size, decode_unicode):
+        for i in range(0, len(self.body), self.size):
+            if self.fail_at is not None and i >= self.fail_at:
+                raise requests.exceptions.ConnectionError("connection dropped")
+            yield self.body[i:i + self.size]
+
+    def close(self):
+        self.closed = True
+
+
+class IterJSONArrayTest(unittest.TestCase):
+
+    def parse(self, body, size):
+        return list(bigcommerce._iterJSONArray(FakeResponse(body, size)))
+
+    def test_numbers_split_across_chunks(self):
+        self.assertEqual(self.parse("[1.5, 2]", 2), [1.5, 2])
+        body = "[1.5, 1e5, -2E-3, 12345, 0.25]"
+        for size in range(1, len(body) + 1):
+            self.assertEqual(self.parse(body, size), [1.5, 1e5, -2E-3, 12345, 0.25])
+
+    def test_every_chunk_size(self):
+        items = [{"sku": "a]b", "price": "1.50", "tags": [1, 2]}, "s\"", True, None, 7]
+        body = " " + json.dumps(items, indent=1) + " "
+        for size in range(1, len(body) + 1):
+            self.assertEqual(self.parse(body, size), items)
+
+    def test_empty_array(self):
+        self.assertEqual(self.parse("[ ]", 1), [])
+
+    def test_truncated_body(self):
+        with self.assertRaises(ValueError):
+            self.parse('[{"sku": "a"}, {"sku": ', 4)
+
+
+
+class BuildPayloadTest(unittest.TestCase):
+
+    def build(self, **values):
+        return bigcommerce.BigCommerce._buildPayload(bigcommerce.Products.product_fields, values)
+
+    def test_none_is_left_out(self):
+        self.assertEqual(self.build(price=None, sku="1"), {"sku": "1"})
+
+    def test_type_errors(self):
+        for values in (
+                       {"inventory_level": "forty"},
+                       {"inventory_level": "--5"},
+                       {"inventory_level": "4.5"},
+                       {"inventory_level": True},
+                       {"price": "cheap"},
+                       {"is_visible": "yes"},
+                       {"categories": 5},
+                       {"date_created": 20150810}
+                       ):
+            with self.assertRaises(ValueError):
+                self.build(**values)
+
+    def test_numbers_are_stripped(self):
+        self.assertEqual(self.build(inventory_level=" 40 ", price=" 2.50"), {"inventory_level": "40", "price": "2.50"})
+        self.assertEqual(self.build(inventory_level="-3"), {"inventory_level": "-3"})
+        self.assertEqual(self.build(inventory_level=8), {"inventory_level": 8})
+
+    def test_choices(self):
+        self.assertEqual(self.build(condition="Used"), {"condition": "Used"})
+        with self.assertRaises(ValueError):
+            self.build(condition="used")
+
+    def test_type_var_is_sent_as_type(self):
+        self.assertEqual(self.build(type_var="digital"), {"type": "digital"})
+        with self.assertRaises(ValueError):
+            self.build(type_var="virtual")
+
+    def test_sku_is_sent_as_string(self):
+        self.assertEqual(self.build(sku=1335), {"sku": "1335"})
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "crawl.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_unsaved_records_are_dropped(self):
+        checkpoint = bigcommerce._Checkpoint(self.path)
+        checkpoint.append("product", [{"id": 1}, {"id": 2}])
+        checkpoint.save(min_id=3)
+        checkpoint.append("product", [{"id": 3}])
+        checkpoint._items.flush()
+        checkpoint._items.close()
+
+        checkpoint = bigcommerce._Checkpoint(self.path)
+        self.assertEqual(checkpoint.state["min_id"], 3)
+        self.assertEqual(list(checkpoint.records()), [("product", {"id": 1}), ("product", {"id": 2})])
+        checkpoint.append("product", [{"id": 4}])
+        checkpoint.save(min_id=5)
+        checkpoint._items.close()
+        self.assertEqual(sorted(os.listdir(self.dir)), ["crawl.json", "crawl.json.items"])
+
+        checkpoint = bigcommerce._Checkpoint(self.path)
+        self.assertEqual([record["id"] for kind, record in checkpoint.records()], [1, 2, 4])
+        checkpoint.clear()
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+class ChangeTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "fingerprints.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def events(self, tracker, records, complete=True):
+        return list(tracker.track(records, complete=complete))
+
+    def test_added_changed_removed(self):
+        tracker = bigcommerce.ChangeTracker(fields=("price", "inventory_level"))
+        a = {"sku": "a", "price": "1.00", "inventory_level": 5}
+        b = {"sku": "b", "price": "2.00", "inventory_level": 1}
+        self.assertEqual(self.events(tracker, [a, b]), [
+                                                       ("added", "a", None, a),
+                                                       ("added", "b", None, b)
+                                                       ])
+        self.assertEqual(self.events(tracker, [a, b]), [])
+        a2 = dict(a, price="1.50", name="ignored")
+        self.assertEqual(self.events(tracker, [a2]), [
+                                                     ("changed", "a", "price", "1.50"),
+                                                     ("removed", "b", None, None)
+                                                     ])
+
+    def test_incomplete_fetch_never_removes(self):
+        tracker = bigcommerce.ChangeTracker(fields=("price",))
+        self.events(tracker, [{"sku": "a", "price": 1}, {"sku": "b", "price": 2}])
+        self.assertEqual(self.events(tracker, [{"sku": "a", "price": 1}], complete=False), [])
+        self.assertEqual(sorted(tracker.fingerprints), ["a", "b"])
+
+    def test_state_is_reloaded(self):
+        record = {"sku": "a", "id": 1, "price": 1}
+        self.events(bigcommerce.ChangeTracker(fields=("price",), path=self.path), [record])
+        tracker = bigcommerce.ChangeTracker(fields=("price",), path=self.path)
+        self.assertEqual(self.events(tracker, [record]), [])
+        self.assertEqual(self.events(tracker, [dict(record, price=2)]), [("changed", "a", "price", 2)])
+
+    def test_other_fields_or_key_start_over(self):
+        record = {"sku": "a", "id": 1, "price": 1, "inventory_level": 3}
+        self.events(bigcommerce.ChangeTracker(fields=("price",), path=self.path), [record])
+        for tracker in (
+                        bigcommerce.ChangeTracker(fields=("price", "inventory_level"), path=self.path),
+                        bigcommerce.ChangeTracker(fields=("price",), key="id", path=self.path)
+                        ):
+            self.assertEqual(tracker.fingerprints, {})
+            self.assertEqual([event.kind for event in self.events(tracker, [record])], ["added"])
+            # reset the file for the next tracker
+            self.events(bigcommerce.ChangeTracker(fields=("price",), path=self.path), [record])
+
+    def test_limit_alone_is_a_complete_crawl(self):
+        products = object.__new__(bigcommerce.Products)
+        calls = []
+
+        def track(records, complete=True):
+            calls.append(complete)
+            return iter(())
+        tracker = bigcommerce.ChangeTracker()
+        tracker.track = track
+        products.iterProducts = lambda **filters: iter(())
+        products.iterProductChanges(tracker)
+        products.iterProductChanges(tracker, limit=50)
+        products.iterProductChanges(tracker, brand_id=3)
+        products.iterProductChanges(tracker, complete=True, brand_id=3)
+        self.assertEqual(calls, [True, True, False, True])
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_failures(self):
+        breaker = bigcommerce._CircuitBreaker(failures=3, reset=60)
+        for i in range(2):
+            breaker.record(False)
+            self.assertTrue(breaker.allow())
+        breaker.record(True)
+        for i in range(3):
+            self.assertTrue(breaker.allow())
+            breaker.record(False)
+        self.assertFalse(breaker.allow())
+
+    def test_single_trial_when_half_open(self):
+        breaker = bigcommerce._CircuitBreaker(failures=1, reset=60)
+        breaker.record(False)
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        breaker.record(True)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_exception_releases_trial(self):
+        bc = object.__new__(bigcommerce.BigCommerce)
+        bc.headers = {}
+        path = "https://breaker.test/api/v2/products/1"
+        breaker = bc._breaker(path)
+        self.addCleanup(bigcommerce.BigCommerce._breakers.pop, bc._endpoint(path))
+        # open long enough ago that the next request is the trial
+        breaker.count = breaker.failures
+        breaker.opened_at = 0
+
+        def fail(*args, **kwargs):
+            raise RuntimeError("not a requests error")
+        session = bigcommerce.BigCommerce.session
+        original = session.request
+        session.request = fail
+        self.addCleanup(setattr, session, "request", original)
+        rate_limit = bigcommerce.BigCommerce.rate_limit
+        bigcommerce.BigCommerce.rate_limit = None
+        self.addCleanup(setattr, bigcommerce.BigCommerce, "rate_limit", rate_limit)
+
+        with self.assertRaises(RuntimeError):
+            bc._request("GET", path)
+        self.assertFalse(breaker.trial)
+        breaker.opened_at = 0
+        self.assertTrue(breaker.allow())
+
+
+class PageRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.products = object.__new__(bigcommerce.Products)
+        self.products.path = "https://retry.test/api/v2/"
+        self.addCleanup(bigcommerce.BigCommerce._breakers.pop, self.products._endpoint(self.products.path), None)
+        self.items = [{"id": i, "sku": str(i)} for i in range(6)]
+        self.body = json.dumps(self.items)
+        self.sent = []
+
+    def listing(self, *responses):
+        responses = list(responses)
+
+        def _listProducts(page=1, stream=False, **filters):
+            self.sent.append((page, filters))
+            return responses.pop(0)
+        self.products._listProducts = _listProducts
+
+    def test_retry_skips_yielded_items(self):
+        first = FakeResponse(self.body, 10, fail_at=40)
+        second = FakeResponse(self.body, 7, fail_at=70)
+        third = FakeResponse(self.body, 3)
+        self.listing(first, second, third)
+        r, items = self.products._streamProductPage(2, limit=6)
+        self.assertEqual(list(items), self.items)
+        self.assertEqual(self.sent, [(2, {"limit": 6})] * 3)
+        self.assertTrue(first.closed and second.closed)
+        breaker = self.products._breaker(self.products.path)
+        self.assertEqual((breaker.count, breaker.opened_at), (0, None))
+
+    def test_gives_up_after_max_retries(self):
+        self.listing(*[FakeResponse(self.body, 10, fail_at=20) for i in range(self.products.max_retries + 1)])
+        r, items = self.products._streamProductPage(1)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            list(items)
+        self.assertEqual(len(self.sent), self.products.max_retries + 1)
+        self.assertEqual(self.products._breaker(self.products.path).count, self.products.max_retries + 1)
+
+    def test_error_on_retry_raises(self):
+        self.listing(FakeResponse(self.body, 10, fail_at=40), FakeResponse("", 1, status_code=404))
+        r, items = self.products._streamProductPage(1)
+        with self.assertRaises(Exception) as caught:
+            list(items)
+        self.assertIn("404", str(caught.exception))
+
+
+class RetryAfterTest(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(bigcommerce._retryAfter("15"), 15)
+        self.assertEqual(bigcommerce._retryAfter(" 2.5 "), 2.5)
+        self.assertEqual(bigcommerce._retryAfter("-4"), 0)
+
+    def test_http_date(self):
+        wait = bigcommerce._retryAfter(formatdate(time.time() + 30, usegmt=True))
+        self.assertTrue(28 <= wait <= 31, wait)
+        self.assertEqual(bigcommerce._retryAfter(formatdate(time.time() - 30, usegmt=True)), 0)
+
+    def test_missing_or_garbage(self):
+        self.assertEqual(bigcommerce._retryAfter(None), 1)
+        self.assertEqual(bigcommerce._retryAfter("soon"), 1)
+        self.assertEqual(bigcommerce._retryAfter("", default=3), 3)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def wait_for_waiters(self, limiter, count):
+        while len(limiter.waiters) < count:
+            time.sleep(0.001)
+
+    def acquire_all(self, limiter, priorities):
+        order = []
+        threads = []
+        for priority in priorities:
+            thread = threading.Thread(target=lambda p=priority: order.append(limiter.acquire(p) or p))
+            thread.start()
+            threads.append(thread)
+            self.wait_for_waiters(limiter, len(threads))
+        return order, threads
+
+    def test_priority_order(self):
+        limiter = bigcommerce._RateLimiter(rate=100, burst=1, aging=60)
+        limiter.pause(0.2)
+        order, threads = self.acquire_all(limiter, [
+                                                    bigcommerce.PRIORITY_BULK,
+                                                    bigcommerce.PRIORITY_NORMAL,
+                                                    bigcommerce.PRIORITY_BULK,
+                                                    bigcommerce.PRIORITY_INTERACTIVE
+                                                    ])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [
+                                 bigcommerce.PRIORITY_INTERACTIVE,
+                                 bigcommerce.PRIORITY_NORMAL,
+                                 bigcommerce.PRIORITY_BULK,
+                                 bigcommerce.PRIORITY_BULK
+                                 ])
+
+    def test_aging_lets_bulk_through(self):
+        limiter = bigcommerce._RateLimiter(rate=100, burst=1, aging=0.05)
+        now = time.time()
+        old_bulk = (bigcommerce.PRIORITY_BULK, 0, now - 0.25)
+        new_interactive = (bigcommerce.PRIORITY_INTERACTIVE, 1, now)
+        self.assertLess(limiter._rank(old_bulk, now), limiter._rank(new_interactive, now))
+
+        limiter.pause(0.3)
+        order, threads = self.acquire_all(limiter, [bigcommerce.PRIORITY_BULK])
+        time.sleep(0.25)
+        more, more_threads = self.acquire_all(limiter, [bigcommerce.PRIORITY_INTERACTIVE])
+        for thread in threads + more_threads:
+            thread.join()
+        self.assertEqual(order, [bigcommerce.PRIORITY_BULK])
+        self.assertEqual(more, [bigcommerce.PRIORITY_INTERACTIVE])
+        self.assertEqual(limiter.waiters, [])
+
+    def test_pause(self):
+        limiter = bigcommerce._RateLimiter(rate=1000, burst=5)
+        start = time.time()
+        limiter.pause(0.2)
+        self.assertFalse(limiter.tryAcquire())
+        limiter.acquire(bigcommerce.PRIORITY_INTERACTIVE)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+
+    def test_try_acquire_leaves_tokens_to_waiters(self):
+        limiter = bigcommerce._RateLimiter(rate=1000, burst=2)
+        self.assertTrue(limiter.tryAcquire())
+        limiter.waiters.append((bigcommerce.PRIORITY_BULK, 0, time.time()))
+        self.assertFalse(limiter.tryAcquire())
+
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bc = object.__new__(bigcommerce.BigCommerce)
+        self.bc.headers = {}
+        self.path = "https://hedge.test/api/v2/products"
+        endpoint = self.bc._endpoint(self.path)
+        bigcommerce.BigCommerce._latencies[endpoint] = bigcommerce.deque([0.01] * 50, maxlen=200)
+        self.addCleanup(bigcommerce.BigCommerce._latencies.pop, endpoint)
+        self.addCleanup(bigcommerce.BigCommerce._breakers.pop, endpoint, None)
+        self.sent = []
+        session = bigcommerce.BigCommerce.session
+        original = session.request
+        session.request = self.request
+        self.addCleanup(setattr, session, "request", original)
+        limiter = bigcommerce.BigCommerce._rate_limiter
+        self.addCleanup(setattr, bigcommerce.BigCommerce, "_rate_limiter", limiter)
+
+    def request(self, method, path, **kwargs):
+        self.sent.append(path)
+        time.sleep(0.1)
+        return FakeResponse("[]", 1)
+
+    def test_idle_budget_hedges(self):
+        bigcommerce.BigCommerce._rate_limiter = bigcommerce._RateLimiter(rate=100, burst=10)
+        self.assertEqual(self.bc._hedgedGet(self.path, None).status_code, 200)
+        self.assertEqual(len(self.sent), 2)
+
+    def test_saturated_budget_does_not_hedge(self):
+        # tokens come much slower than the hedge delay, as under saturation
+        limiter = bigcommerce._RateLimiter(rate=20, burst=1)
+        limiter.tokens = 0
+        bigcommerce.BigCommerce._rate_limiter = limiter
+        threads = [threading.Thread(target=self.bc._hedgedGet, args=(self.path, None)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.sent), 8)
+
+    def test_429_is_closed_before_pausing(self):
+        limiter = bigcommerce._RateLimiter(rate=100, burst=10)
+        bigcommerce.BigCommerce._rate_limiter = limiter
+        busy = FakeResponse("", 1, status_code=429)
+        busy.headers = {"Retry-After": "0.05"}
+        responses = [busy, FakeResponse("[]", 1)]
+
+        def pause(seconds):
+            self.assertTrue(busy.closed)
+            bigcommerce._RateLimiter.pause(limiter, seconds)
+        limiter.pause = pause
+        self.request = lambda method, path, **kwargs: responses.pop(0)
+        bigcommerce.BigCommerce.session.request = self.request
+        self.assertEqual(self.bc._request("GET", self.path, stream=True).status_code, 200)
+        self.assertEqual(responses, [])
+
+
+class ImportFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.products = object.__new__(bigcommerce.Products)
+        self.sent = []
+
+        def updateProduct(id, **values):
+            self.sent.append((id, values))
+            return FakeResponse("", 1, status_code=404 if id == 404 else 200)
+        self.products.updateProduct = updateProduct
+        self.index = {
+                      "a": (1, (5, "10.0000")),
+                      "b": (2, (0, "3.5000")),
+                      "gone": (404, (1, "1.0000"))
+                      }
+
+    def feed(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_only_changes_are_sent_normalized(self):
+        path = self.feed("feed.csv", "sku,inventory_level,price\na, 5 ,10.00\nb,7, 3.25\nc,1,1\n,2,2\n")
+        report = self.products.importFeed(path, index=self.index, threads=1)
+        self.assertEqual(self.sent, [(2, {"inventory_level": 7, "price": "3.25"})])
+        self.assertEqual(report["unchanged"], 1)
+        self.assertEqual(report["not_found"], ["c"])
+        self.assertEqual([failure["sku"] for failure in report["failed"]], [None])
+        self.assertEqual(report["updates"][0]["changes"], {"inventory_level": [0, 7], "price": ["3.5000", "3.25"]})
+        self.assertEqual(self.index["b"], (2, (7, "3.25")))
+
+    def test_last_row_for_a_sku_wins(self):
+        path = self.feed("feed.jsonl", '{"sku": "b", "inventory_level": 1}\n\n{"sku": "b", "inventory_level": "2"}\n')
+        self.products.importFeed(path, index=self.index, threads=1)
+        self.assertEqual(self.sent, [(2, {"inventory_level": 2})])
+
+    def test_json_array_feed(self):
+        path = self.feed("feed.json", json.dumps([{"sku": "a", "price": 11}, {"sku": "b", "inventory_level": 0}]))
+        report = self.products.importFeed(path, index=self.index, threads=1)
+        self.assertEqual(self.sent, [(1, {"price": "11"})])
+        self.assertEqual(report["unchanged"], 1)
+
+    def test_invalid_and_failed_updates(self):
+        path = self.feed("feed.csv", "sku,inventory_level,price\na,lots,10\ngone,2,1\n")
+        report = self.products.importFeed(path, index=self.index, threads=1)
+        self.assertEqual([failure["sku"] for failure in report["failed"]], ["a", "gone"])
+        self.assertEqual(report["updates"], [])
+        self.assertEqual(self.index["gone"], (404, (1, "1.0000")))
+
+    def test_dry_run_sends_nothing(self):
+        path = self.feed("feed.csv", "sku,inventory_level\na,6\n")
+        report_path = os.path.join(self.dir, "report.csv")
+        report = self.products.importFeed(path, index=self.index, dry_run=True, report_path=report_path)
+        self.assertEqual(self.sent, [])
+        self.assertEqual([update["status"] for update in report["updates"]], ["dry run"])
+        with open(report_path) as f:
+            self.assertEqual(f.read().splitlines()[1], "a,1,inventory_level,5,6,dry run")
+
+
+if __name__ == "__main__":
+    unittest.main()